@@ -1,26 +1,70 @@
 from flask import Flask, request
-import datetime
+from flask.json.provider import JSONProvider
+import atexit
 import collections
+import functools
+import logging
+import logging.handlers
 import math
+import queue
+import threading
 import time
 import os
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
+import orjson
+import geohash
+from pyroaring import BitMap
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class OrjsonProvider(JSONProvider):
+    """リクエスト / レスポンスの JSON を orjson で処理する"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # ======================
 # 設定値（必要に応じて調整）
 # ======================
 R_EARTH = 6371000.0     # 地球半径[m]
 GEO_PREC = 8            # Geohash 精度（≈38mメッシュ）
+GEO_PREFIX_PREC = 6     # 候補をまとめて引く粗い Geohash 精度（≈1.2kmメッシュ）
 THRESH_M = 10.0         # 近接判定の閾値[m]
 TIME_WINDOW = 60.0      # 直近何秒の測位を比較するか
-RELAX_RATIO = 1.2       # 近似距離でのゆるい判定倍率（誤脱落回避）
+VECTOR_MIN = 8          # 候補数がこれ以上なら NumPy でまとめて判定
 
 DISCORD_WEBHOOK_URL = os.getenv("DISCORD_WEBHOOK_URL")  # Discord Webhook（任意）
 
 
+# ======================
+# ログ（%s の埋め込みは呼び出し側スレッド、asctime 付与と書き出しは QueueListener のスレッド）
+# ======================
+logger = logging.getLogger("prox")
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+
 # ======================
 # ユーザー管理
 # ======================
@@ -32,12 +76,14 @@ class User:
         self.location_histry = collections.deque(maxlen=20)  # 直近20件の位置履歴
         self.last_ts = 0.0
         self.last_gh = None
+        self.cos_phi = 1.0  # 最新位置の cos(緯度)（比較のたびに再計算しない）
 
     def add_location(self, lat, lon, ts=None):
         if ts is None:
             ts = time.time()
         self.location_histry.append((lat, lon))
         self.last_ts = ts
+        self.cos_phi = math.cos(math.radians(lat))
 
     def latest_location(self):
         if self.location_histry:
@@ -56,187 +102,281 @@ def haversine(lat1, lon1, lat2, lon2):
     a = math.sin(dphi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda/2)**2
     return 2 * R_EARTH * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
+def haversine_vector(lat1, lon1, lats, lons):
+    """1地点と複数地点の距離を一括計算（m の ndarray を返す）"""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lats)
+    dphi = np.radians(lats - lat1)
+    dlambda = np.radians(lons - lon1)
+    a = np.sin(dphi/2)**2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda/2)**2
+    return 2 * R_EARTH * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
 
 # ======================
-# 高速化ユーティリティ：Geohash
+# 高速化ユーティリティ：整数 Geohash（インデックスのキー）
 # ======================
-__BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
-__NEIGHBORS = {
-    'right':  {'even': "bc01fg45238967deuvhjyznpkmstqrwx"},
-    'left':   {'even': "238967debc01fg45kmstqrwxuvhjyznp"},
-    'top':    {'even': "p0r21436x8zb9dcf5h7kjnmqesgutwvy"},
-    'bottom': {'even': "14365h7k9dcfesgujnmqp0r2twvyx8zb"}
-}
-__BORDERS = {
-    'right':  {'even': "bcfguvyz"},
-    'left':   {'even': "0145hjnp"},
-    'top':    {'even': "prxz"},
-    'bottom': {'even': "028b"}
-}
-def _neighbor(hashcode: str, direction: str) -> str:
-    if not hashcode:
-        return ""
-    last = hashcode[-1]
-    parent = hashcode[:-1]
-    type_ = 'even' if (len(hashcode) % 2) == 0 else 'odd'
-
-    # 偶奇に応じてマップを切替（緯度経度の分割順の違いに起因）
-    if type_ == 'odd':
-        if direction in ('right','left'):
-            direction_map = {
-                'right': __NEIGHBORS['top']['even'],
-                'left':  __NEIGHBORS['bottom']['even']
-            }
-            border_map = {
-                'right': __BORDERS['top']['even'],
-                'left':  __BORDERS['bottom']['even']
-            }
-        else:
-            direction_map = {
-                'top':    __NEIGHBORS['right']['even'],
-                'bottom': __NEIGHBORS['left']['even']
-            }
-            border_map = {
-                'top':    __BORDERS['right']['even'],
-                'bottom': __BORDERS['left']['even']
-            }
-    else:
-        direction_map = {d: __NEIGHBORS[d]['even'] for d in __NEIGHBORS}
-        border_map    = {d: __BORDERS[d]['even']    for d in __BORDERS}
-
-    if last in border_map[direction]:
-        parent = _neighbor(parent, direction)
-    idx = __BASE32.find(last)
-    return (parent + __BASE32[direction_map[direction].find(__BASE32[idx])]) if parent is not None else ""
-
-def neighbors(gh: str):
-    n  = _neighbor(gh, 'top')
-    s  = _neighbor(gh, 'bottom')
-    e  = _neighbor(gh, 'right')
-    w  = _neighbor(gh, 'left')
-    ne = _neighbor(n, 'right')
-    nw = _neighbor(n, 'left')
-    se = _neighbor(s, 'right')
-    sw = _neighbor(s, 'left')
-    return {n, s, e, w, ne, nw, se, sw}
-
-def encode_geohash(lat: float, lon: float, precision: int = GEO_PREC) -> str:
-    lat_interval = [-90.0, 90.0]
-    lon_interval = [-180.0, 180.0]
-    geohash = []
-    bits = [16, 8, 4, 2, 1]
-    bit = 0
-    ch = 0
-    even = True
-    while len(geohash) < precision:
-        if even:
-            mid = (lon_interval[0] + lon_interval[1]) / 2
-            if lon > mid:
-                ch |= bits[bit]
-                lon_interval[0] = mid
-            else:
-                lon_interval[1] = mid
-        else:
-            mid = (lat_interval[0] + lat_interval[1]) / 2
-            if lat > mid:
-                ch |= bits[bit]
-                lat_interval[0] = mid
-            else:
-                lat_interval[1] = mid
-        even = not even
-        if bit < 4:
-            bit += 1
-        else:
-            geohash.append(__BASE32[ch])
-            bit = 0
-            ch = 0
-    return ''.join(geohash)
+# 文字列 Geohash と同じビット列（経度から交互）を 1 つの int で持つ
+_GH_BITS = 5 * GEO_PREC
+_LON_BITS = (_GH_BITS + 1) // 2
+_LAT_BITS = _GH_BITS // 2
+_LON_SHIFT = 1 - (_GH_BITS & 1)  # 総ビット数が偶数なら最下位ビットは緯度
+_LAT_SHIFT = _GH_BITS & 1
+
+def _part1by1(x):
+    """x の各ビットの間に 0 を挟む（Morton 符号化, SWAR）"""
+    x &= 0x00000000FFFFFFFF
+    x = (x | (x << 16)) & 0x0000FFFF0000FFFF
+    x = (x | (x << 8))  & 0x00FF00FF00FF00FF
+    x = (x | (x << 4))  & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x << 2))  & 0x3333333333333333
+    x = (x | (x << 1))  & 0x5555555555555555
+    return x
+
+def _compact1by1(x):
+    """_part1by1 の逆（1つおきのビットを詰める）"""
+    x &= 0x5555555555555555
+    x = (x | (x >> 1))  & 0x3333333333333333
+    x = (x | (x >> 2))  & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x >> 4))  & 0x00FF00FF00FF00FF
+    x = (x | (x >> 8))  & 0x0000FFFF0000FFFF
+    x = (x | (x >> 16)) & 0x00000000FFFFFFFF
+    return x
+
+def encode_geohash_int(lat: float, lon: float) -> int:
+    """精度 GEO_PREC の Geohash を整数で返す（文字列版の base32 デコード値と同じ）"""
+    # python-geohash（C 実装）の 64bit Geohash の上位 _GH_BITS ビット
+    return geohash.encode_uint64(lat, lon) >> (64 - _GH_BITS)
+
+# インターリーブ後の緯度ビット・経度ビットの位置
+_LAT_PART = _part1by1((1 << _LAT_BITS) - 1) << _LAT_SHIFT
+_LON_PART = _part1by1((1 << _LON_BITS) - 1) << _LON_SHIFT
+
+@functools.lru_cache(maxsize=200_000)
+def neighbors_int(gh: int):
+    """整数 Geohash の8近傍（緯度・経度インデックスを ±1 して再インターリーブ）"""
+    # 緯度・経度のビットは独立に OR で組めるので、±1 した 4 通りだけ再インターリーブする
+    ilat = _compact1by1(gh >> _LAT_SHIFT)
+    ilon = _compact1by1(gh >> _LON_SHIFT)
+    lon_mask = (1 << _LON_BITS) - 1  # 経度は日付変更線で一周
+    x0 = gh & _LON_PART
+    xw = _part1by1((ilon - 1) & lon_mask) << _LON_SHIFT
+    xe = _part1by1((ilon + 1) & lon_mask) << _LON_SHIFT
+    y0 = gh & _LAT_PART
+    cells = [y0 | xw, y0 | xe]
+    if ilat > 0:  # 極をまたぐセルはなし
+        ys = _part1by1(ilat - 1) << _LAT_SHIFT
+        cells += (ys | xw, ys | x0, ys | xe)
+    if ilat < (1 << _LAT_BITS) - 1:
+        yn = _part1by1(ilat + 1) << _LAT_SHIFT
+        cells += (yn | xw, yn | x0, yn | xe)
+    return frozenset(cells)
+
+# 整数 Geohash の上位ビット = 短い精度の Geohash（文字列の前方一致と同じ）
+_PREFIX_SHIFT = 5 * (GEO_PREC - GEO_PREFIX_PREC)
+
+def geohash_prefix(gh: int) -> int:
+    """精度 GEO_PREFIX_PREC の親セル"""
+    return gh >> _PREFIX_SHIFT
+
+@functools.lru_cache(maxsize=200_000)
+def neighbors_share_prefix(gh: int) -> bool:
+    """8近傍がすべて同じ親セルに収まるか（親セルの境界に接していないか）"""
+    p = gh >> _PREFIX_SHIFT
+    return all((h >> _PREFIX_SHIFT) == p for h in neighbors_int(gh))
 
 
 # ======================
-# 高速化ユーティリティ：BBox / 近似距離
+# 高速化ユーティリティ：近似距離（等距円筒）
 # ======================
-def equirectangular_m(lat1, lon1, lat2, lon2):
-    """等距円筒近似距離[m]（短距離で高速・十分高精度）"""
-    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
-    y = math.radians(lat2 - lat1)
-    return R_EARTH * math.sqrt(x*x + y*y)
-
-def bbox_pass(lat1, lon1, lat2, lon2, thresh_m):
-    """バウンディングボックス（緯度・経度の差が大きすぎるものを即除外）"""
-    deg_per_m = 180.0 / math.pi / R_EARTH
-    dlat_max = thresh_m * deg_per_m
-    # 経度は緯度で縮む（高緯度ガード付）
-    dlon_max = dlat_max / max(0.2, math.cos(math.radians(lat1)))
-    return (abs(lat1 - lat2) <= dlat_max) and (abs(lon1 - lon2) <= dlon_max)
-
-def near_with_stages(lat1, lon1, lat2, lon2, thresh_m=THRESH_M, relax_ratio=RELAX_RATIO):
-    """1) BBox → 2) 等距円筒近似 → 3) Haversine（確定）"""
-    if not bbox_pass(lat1, lon1, lat2, lon2, thresh_m):
-        return False
-    if equirectangular_m(lat1, lon1, lat2, lon2) > (thresh_m * relax_ratio):
-        return False
-    return haversine(lat1, lon1, lat2, lon2) <= thresh_m
+M_PER_DEG = R_EARTH * math.pi / 180.0  # 緯度1度あたりの距離[m]
+DEG_PER_M = 1.0 / M_PER_DEG            # 1m あたりの緯度[度]
 
 
 # ======================
 # Geohash インデックス
 # ======================
-geo_index = defaultdict(set)  # geohash -> set(user_id)
+# セルの中身は行番号（下の SoA 配列の添字）のビットマップ
+geo_index = defaultdict(BitMap)         # 整数 geohash -> BitMap(行番号)
+geo_index_prefix = defaultdict(BitMap)  # 親セル（geohash_prefix）-> BitMap(行番号)
+_EMPTY = BitMap()
+
+# 最新位置を行ごとに並べた配列（struct-of-arrays）。候補の座標は行番号でまとめて取り出す
+_capacity = 1024
+_lats = np.empty(_capacity, dtype=np.float64)
+_lons = np.empty(_capacity, dtype=np.float64)
+_last_ts = np.empty(_capacity, dtype=np.float64)
+_row_of = {}  # user_id -> 行番号
+_ids = []     # 行番号 -> user_id
+
+# 更新順の (ts, user_id, geohash)。古いものから順にインデックスを掃除する
+_expiry = collections.deque()
+
+def _alloc_row(user_id):
+    """user_id に新しい行を割り当てる（満杯なら配列を倍に伸ばす）"""
+    global _capacity, _lats, _lons, _last_ts
+    row = len(_ids)
+    if row >= _capacity:
+        _capacity *= 2
+        _lats = np.resize(_lats, _capacity)
+        _lons = np.resize(_lons, _capacity)
+        _last_ts = np.resize(_last_ts, _capacity)
+    _ids.append(user_id)
+    _row_of[user_id] = row
+    return row
 
 def upsert_user(users_dict, user_id, lat, lon, ts=None):
     if user_id not in users_dict:
         users_dict[user_id] = User(user_id)
     u = users_dict[user_id]
-    # 旧 geohash から外す
-    if u.last_gh is not None:
-        geo_index[u.last_gh].discard(user_id)
+    row = _row_of.get(user_id)
+    if row is None:
+        row = _alloc_row(user_id)
     # 位置更新
     u.add_location(lat, lon, ts=ts if ts is not None else time.time())
-    # 新 geohash に追加
-    gh = encode_geohash(lat, lon, GEO_PREC)
-    u.last_gh = gh
-    geo_index[gh].add(user_id)
+    # セルが変わったときだけインデックスを付け替える（止まっている端末は何もしない）
+    gh = encode_geohash_int(lat, lon)
+    if u.last_gh != gh:
+        prefix = geohash_prefix(gh)
+        if u.last_gh is not None:
+            _index_discard(geo_index, u.last_gh, row)
+            old_prefix = geohash_prefix(u.last_gh)
+            if old_prefix != prefix:
+                _index_discard(geo_index_prefix, old_prefix, row)
+        geo_index[gh].add(row)
+        geo_index_prefix[prefix].add(row)
+        u.last_gh = gh
+    _lats[row] = lat
+    _lons[row] = lon
+    _last_ts[row] = u.last_ts
+    _expiry.append((u.last_ts, user_id, gh))
+
+def _index_discard(index, key, row):
+    """セルから row を外し、空になったセルは辞書ごと消す（defaultdict に空セルを作らない）"""
+    cell = index.get(key)
+    if cell is not None:
+        cell.discard(row)
+        if not cell:
+            del index[key]
+
+def _evict_stale(users_dict, now, time_window=TIME_WINDOW):
+    """TIME_WINDOW より古い測位しかないユーザーを geohash インデックスから外す"""
+    cutoff = now - time_window
+    while _expiry and _expiry[0][0] < cutoff:
+        ts, uid, gh = _expiry.popleft()
+        u = users_dict.get(uid)
+        # その後に更新があったエントリは読み飛ばす（旧セルからは upsert_user で外し済み）
+        if u is None or u.last_ts != ts or u.last_gh != gh:
+            continue
+        row = _row_of[uid]
+        _index_discard(geo_index, gh, row)
+        _index_discard(geo_index_prefix, geohash_prefix(gh), row)
+        u.last_gh = None
 
 def check_proximity_geohash(users_dict, user_id, threshold=THRESH_M, time_window=TIME_WINDOW):
     """
-    user_id の最新位置を基準に、同セル＋8近傍セルだけを候補にして
-    BBox→近似→Haversine で近接を判定。[(相手ID, 距離m), ...] を返す。
+    user_id の最新位置を基準に、同セル＋8近傍セル（を含む親セル）だけを候補にして
+    等距円筒近似（cheap ruler）の距離²で近接を判定。[(相手ID, 距離m), ...] を返す。
+    インデックスからの掃除は max(time_window, TIME_WINDOW) より古いユーザーだけ
+    （インデックスは常に TIME_WINDOW 分は保持する。それより短い time_window は判定時に絞る）。
     """
     now = time.time()
+    _evict_stale(users_dict, now, max(time_window, TIME_WINDOW))
     u = users_dict.get(user_id)
     if not u or not u.latest_location():
         return []
     lat1, lon1 = u.latest_location()
-    gh = u.last_gh or encode_geohash(lat1, lon1, GEO_PREC)
-
-    cand_hashes = {gh} | neighbors(gh)
-    candidates = set()
-    for h in cand_hashes:
-        candidates |= geo_index.get(h, set())
-
-    hits = []
-    for vid in candidates:
-        if vid == user_id:
-            continue
-        v = users_dict.get(vid)
-        if not v or not v.latest_location():
-            continue
-        if (now - v.last_ts) > time_window:
-            continue
-        lat2, lon2 = v.latest_location()
-        if near_with_stages(lat1, lon1, lat2, lon2, thresh_m=threshold, relax_ratio=RELAX_RATIO):
-            d = haversine(lat1, lon1, lat2, lon2)
-            hits.append((vid, d))
-    return hits
+    gh = u.last_gh if u.last_gh is not None else encode_geohash_int(lat1, lon1)
+
+    # 9セルとも同じ親セルに収まり、親セルの人数が少なければ、親セルをそのまま候補にする（和集合なし）
+    # 人が多い親セル（≈1024セル分）をまとめて判定すると 9 セルの和集合より遅いので使わない
+    candidates = None
+    if neighbors_share_prefix(gh):
+        parent = geo_index_prefix.get(geohash_prefix(gh), _EMPTY)
+        if len(parent) < VECTOR_MIN:
+            candidates = parent
+    if candidates is None:
+        candidates = BitMap.union(geo_index.get(gh, _EMPTY), *(geo_index.get(h, _EMPTY) for h in neighbors_int(gh)))
+    my_row = _row_of[user_id]
+
+    # 等距円筒近似の係数（1度あたりの距離[m]）はリクエストごとに1回だけ計算
+    # 閾値 10m 程度なら誤差は cm オーダーなので、sqrt は返却する hits だけ
+    kx = M_PER_DEG * u.cos_phi
+    ky = M_PER_DEG
+    thresh_sq = threshold * threshold
+    # BBox の幅もループの外で1回だけ。10m 四方では経度の縮みは候補間で同じとみなせる
+    dlat_max = threshold * DEG_PER_M
+    dlon_max = dlat_max / max(0.2, u.cos_phi)
+
+    # 候補が少ないときは NumPy の呼び出しコストの方が高いのでスカラーで判定
+    if len(candidates) < VECTOR_MIN:
+        hits = []
+        for row in candidates:
+            if row == my_row:
+                continue
+            vid = _ids[row]
+            v = users_dict.get(vid)
+            if not v or (now - v.last_ts) > time_window:
+                continue
+            loc = v.latest_location()
+            if not loc:
+                continue
+            lat2, lon2 = loc
+            dlat = lat2 - lat1
+            dlon = lon2 - lon1
+            if abs(dlat) > dlat_max or abs(dlon) > dlon_max:
+                continue
+            dx = dlon * kx
+            dy = dlat * ky
+            d2 = dx*dx + dy*dy
+            if d2 <= thresh_sq:
+                hits.append((vid, math.sqrt(d2)))
+        return hits
+
+    # 行番号を集めて SoA 配列から一括で取り出す
+    rows = np.frombuffer(candidates.to_array(), dtype=np.uint32).astype(np.int64)
+    dlat = _lats[rows] - lat1
+    dlon = _lons[rows] - lon1
+
+    # BBox・時刻・自分自身の除外を1つのマスクにまとめる（分岐なし）
+    mask = (np.abs(dlat) <= dlat_max) & (np.abs(dlon) <= dlon_max)
+    mask &= (now - _last_ts[rows]) <= time_window
+    mask &= rows != my_row
+    surv = np.flatnonzero(mask)
+
+    # 生き残りだけ距離²で確定
+    dx = dlon[surv] * kx
+    dy = dlat[surv] * ky
+    d2 = dx*dx + dy*dy
+    ok = d2 <= thresh_sq
+    return [(_ids[r], math.sqrt(d)) for r, d in zip(rows[surv][ok].tolist(), d2[ok].tolist())]
 
 
 # ======================
 # Discord 通知（任意）
 # ======================
+# 送信はバックグラウンドで行い、API のレスポンスを Discord の応答待ちで止めない
+_notify_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="discord")
+# 未送信の通知の上限。Discord が遅い・429 のときに溜め込まず、溢れた分は捨てる
+_notify_slots = threading.BoundedSemaphore(32)
+# keep-alive で TCP/TLS 接続を使い回す（毎回のハンドシェイクを省く）
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+def _post_discord(payload):
+    try:
+        resp = _session.post(DISCORD_WEBHOOK_URL, json=payload, timeout=5)
+        resp.raise_for_status()  # 4xx/5xx（レート制限を含む）もエラーとして記録する
+    finally:
+        _notify_slots.release()
+
+def _log_notify_error(future):
+    e = future.exception()
+    if e is not None:
+        logger.warning("[discord] notify error: %s", e)
+
 def notify_discord(user_id: str, hits):
     """
     hits: [(相手ID, 距離m), ...]
+    送信は _notify_pool に投げてすぐ戻る。未送信が上限に達していれば捨てる。
     """
     if not DISCORD_WEBHOOK_URL or not hits:
         return
@@ -244,57 +384,134 @@ def notify_discord(user_id: str, hits):
     for vid, dist_m in hits:
         lines.append(f"- 相手: `{vid}` / 距離: **{dist_m:.2f} m**")
     payload = {"content": "\n".join(lines)}
-    try:
-        requests.post(DISCORD_WEBHOOK_URL, data=payload, timeout=5)
-    except Exception as e:
-        print(f"[discord] notify error: {e}")
+    if not _notify_slots.acquire(blocking=False):
+        logger.warning("[discord] too many pending notifications, dropped one for %s", user_id)
+        return
+    future = _notify_pool.submit(_post_discord, payload)
+    future.add_done_callback(_log_notify_error)
+
+
+# ======================
+# 近接判定ワーカー（リクエストの外で実行）
+# ======================
+# API は位置を反映してキューに積むだけ。判定と通知はワーカースレッドが行う
+_index_lock = threading.Lock()  # users / geohash インデックス / SoA 配列を守る
+_work_q = queue.SimpleQueue()   # 判定待ちの user_id
+_pending = set()                # キューに積まれて未処理の user_id（同じユーザーはまとめる）
+_pending_lock = threading.Lock()
+recent_hits = defaultdict(lambda: collections.deque(maxlen=20))  # user_id -> 直近の検知結果
+
+def enqueue_proximity(user_id):
+    """user_id の近接判定を予約（すでに待っていれば何もしない）"""
+    with _pending_lock:
+        if user_id in _pending:
+            return
+        _pending.add(user_id)
+    _work_q.put(user_id)
+
+def _prune_hits(now):
+    """最新の検知が TIME_WINDOW より古いユーザーを recent_hits から消す（ワーカースレッドからのみ呼ぶ）"""
+    cutoff = now - TIME_WINDOW
+    for uid in [uid for uid, dq in recent_hits.items() if not dq or dq[-1]["ts"] <= cutoff]:
+        del recent_hits[uid]
+
+def _drain():
+    last_prune = time.time()
+    while True:
+        user_id = _work_q.get()
+        # 処理中に届いた更新は次の判定として積み直せるよう、先に外しておく
+        with _pending_lock:
+            _pending.discard(user_id)
+        try:
+            with _index_lock:
+                hits = check_proximity_geohash(users, user_id, threshold=THRESH_M, time_window=TIME_WINDOW)
+            now = time.time()
+            for vid, dist_m in hits:
+                logger.info("すれ違い成功: %s と %s が %.2fm", user_id, vid, dist_m)
+                recent_hits[user_id].append({"user": vid, "distance_m": round(dist_m, 2), "ts": now})
+            if now - last_prune >= TIME_WINDOW:
+                _prune_hits(now)
+                last_prune = now
+            # Discord通知（任意設定時のみ）
+            notify_discord(user_id, hits)
+        except Exception:
+            logger.exception("[proximity] check failed for %s", user_id)
+
+threading.Thread(target=_drain, name="proximity", daemon=True).start()
 
 
 # ======================
 # 互換用（従来の全探索：必要なら比較用）
 # ======================
 def check_proximity(users_dict, threshold=10):
-    user_ids = list(users_dict.keys())
-    for i in range(len(user_ids)):
-        for j in range(i + 1, len(user_ids)):
-            loc1 = users_dict[user_ids[i]].latest_location()
-            loc2 = users_dict[user_ids[j]].latest_location()
-            if loc1 and loc2:
-                lat1, lon1 = loc1
-                lat2, lon2 = loc2
-                distance = haversine(lat1, lon1, lat2, lon2)
-                if distance <= threshold:
-                    print(f"すれ違い成功: {user_ids[i]} と {user_ids[j]} が {distance:.2f}m")
-                    return True
-    return False
+    """全ユーザー間の距離行列をブロードキャストで一括計算（O(N²) メモリ）"""
+    ids = []
+    locs = []
+    for uid, u in users_dict.items():
+        loc = u.latest_location()
+        if loc:
+            ids.append(uid)
+            locs.append(loc)
+    if len(locs) < 2:
+        return False
+    latlon = np.array(locs, dtype=np.float64)
+    lats, lons = latlon[:, 0], latlon[:, 1]
+    dist = haversine_vector(lats[:, None], lons[:, None], lats[None, :], lons[None, :])
+    pairs = np.argwhere(np.triu(dist <= threshold, k=1))
+    if len(pairs) == 0:
+        return False
+    i, j = pairs[0]
+    logger.info("すれ違い成功: %s と %s が %.2fm", ids[i], ids[j], dist[i, j])
+    return True
 
 
 # ======================
 # API: 位置受信（POST）
 # ======================
+def _coord(value, limit, include_limit=True):
+    """JSON の数値をそのまま使う（型と範囲だけ確認し、不正なら None）
+    include_limit=False なら +limit を範囲外とする（geohash の緯度は [-90, 90)）"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if value < -limit or value > limit or (value == limit and not include_limit):
+        return None
+    return value
+
 @app.route('/api/location', methods=["POST"])
 def location():
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return {"status": "NG", "error": "invalid JSON"}, 400
     user_id = data.get('userID')
-    latitude = float(data.get('latitude'))
-    longitude = float(data.get('longitude'))
-    print(f"[{datetime.datetime.now()}], [userID: {user_id}] Lat: {latitude} Lon: {longitude}")
+    if not isinstance(user_id, str) or not user_id:
+        return {"status": "NG", "error": "invalid userID"}, 400
+    latitude = _coord(data.get('latitude'), 90.0, include_limit=False)
+    longitude = _coord(data.get('longitude'), 180.0)
+    if latitude is None or longitude is None:
+        return {"status": "NG", "error": "invalid latitude/longitude"}, 400
+    logger.info("[userID: %s] Lat: %s Lon: %s", user_id, latitude, longitude)
 
     # Geohashインデックスに反映
-    upsert_user(users, user_id, latitude, longitude, ts=time.time())
+    with _index_lock:
+        upsert_user(users, user_id, latitude, longitude, ts=time.time())
 
-    # 自分の周辺だけ高速探索（同セル＋8近傍 → BBox → 近似 → Haversine）
-    hits = check_proximity_geohash(users, user_id, threshold=THRESH_M, time_window=TIME_WINDOW)
-    for vid, dist_m in hits:
-        print(f"すれ違い成功: {user_id} と {vid} が {dist_m:.2f}m")
+    # 近接判定はワーカーに任せてすぐ返す（結果は /api/hits/<userID>）
+    enqueue_proximity(user_id)
+    return {"status": "OK"}, 202
 
-    # Discord通知（任意設定時のみ）
-    notify_discord(user_id, hits)
 
-    return {
-        "status": "OK",
-        "hits": [{"user": vid, "distance_m": round(dist_m, 2)} for vid, dist_m in hits]
-    }, 200
+# ======================
+# API: 検知結果（GET）
+# ======================
+@app.route('/api/hits/<user_id>')
+def user_hits(user_id):
+    """直近 TIME_WINDOW 秒の検知結果。?since=<ts> を付けるとそれより新しいものだけ返す"""
+    cutoff = time.time() - TIME_WINDOW
+    since = request.args.get('since', type=float)
+    if since is not None:
+        cutoff = max(cutoff, since)
+    hits = list(recent_hits.get(user_id, ()))
+    return {"status": "OK", "hits": [h for h in hits if h["ts"] > cutoff]}, 200
 
 
 # ======================
@@ -319,6 +536,8 @@ def test_page():
 <div class="log" id="log"></div>
 <script>
 let watchId = null;
+let hitsTimer = null;
+let lastHitTs = 0;  // 表示済みの検知結果の最新時刻
 const log = (m)=>{ 
   const el=document.getElementById('log'); 
   el.textContent += m + "\\n"; 
@@ -335,6 +554,15 @@ async function postLocation(uid, lat, lon){
   log("POST -> " + res.status + " " + JSON.stringify(j));
 }
 
+// 近接判定は 202 の後にワーカーで走るので、POST 直後ではなくタイマーで取りに行く
+async function pollHits(uid){
+  const h = await fetch("/api/hits/" + encodeURIComponent(uid) + "?since=" + lastHitTs).then(r=>r.json()).catch(()=>({}));
+  if(h.hits && h.hits.length){
+    log("hits -> " + JSON.stringify(h.hits));
+    lastHitTs = Math.max(lastHitTs, ...h.hits.map(x=>x.ts));
+  }
+}
+
 document.getElementById("start").onclick = ()=>{
   const uid = document.getElementById("uid").value.trim();
   if(!uid){ alert("User ID を入れてください"); return; }
@@ -351,6 +579,7 @@ document.getElementById("start").onclick = ()=>{
     (err)=>{ log("geo error: " + err.message); },
     { enableHighAccuracy: true, maximumAge: 3000, timeout: 10000 }
   );
+  hitsTimer = setInterval(()=>pollHits(uid), 2000);
   document.getElementById("start").disabled = true;
   document.getElementById("stop").disabled = false;
 };
@@ -358,6 +587,8 @@ document.getElementById("start").onclick = ()=>{
 document.getElementById("stop").onclick = ()=>{
   if(watchId !== null){
     navigator.geolocation.clearWatch(watchId);
+    clearInterval(hitsTimer);
+    hitsTimer = null;
     log("Stopped tracking");
     watchId = null;
     document.getElementById("start").disabled = false;
@@ -370,6 +601,10 @@ document.getElementById("stop").onclick = ()=>{
 # ======================
 # エントリポイント
 # ======================
+# 開発用サーバー。本番は gunicorn のスレッドワーカーで起動する（requirements.txt には含めない。pip install gunicorn）:
+#   gunicorn -w 1 -k gthread --threads 8 -b 0.0.0.0:5003 --certfile cert.pem --keyfile key.pem app:app
+# ユーザー・インデックスはプロセス内メモリなので、ワーカープロセスは 1 つ（-w 1）にしてスレッドで並列化する
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5003, debug=True, ssl_context=("cert.pem","key.pem"))
+    debug = os.getenv("FLASK_DEBUG") == "1"  # デバッガ・リローダーは明示したときだけ
+    app.run(host="0.0.0.0", port=5003, debug=debug, ssl_context=("cert.pem","key.pem"))
 
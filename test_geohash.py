@@ -0,0 +1,31 @@
+import random
+
+import geohash
+import pytest
+
+import app
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def _decode_base32(s):
+    """文字列 Geohash を整数 Geohash に変換"""
+    n = 0
+    for c in s:
+        n = (n << 5) | _BASE32.index(c)
+    return n
+
+
+_rng = random.Random(0)
+POINTS = [(_rng.uniform(-90, 90), _rng.uniform(-180, 180)) for _ in range(500)] + [
+    (89.9999, 0.0), (-89.9999, 0.0), (89.9999, 180.0), (-89.9999, -180.0),
+    (0.0, 180.0), (0.0, -180.0), (35.0, 180.0), (-35.0, -180.0),
+]
+
+
+@pytest.mark.parametrize("lat,lon", POINTS)
+def test_matches_python_geohash(lat, lon):
+    s = geohash.encode(lat, lon, app.GEO_PREC)
+    gh = app.encode_geohash_int(lat, lon)
+    assert gh == _decode_base32(s)
+    assert app.neighbors_int(gh) == {_decode_base32(n) for n in geohash.neighbors(s)}